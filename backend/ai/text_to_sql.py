@@ -1,26 +1,113 @@
 import openai
 import pandas as pd
+import numpy as np
+import asyncio
+import hashlib
+import os
+import random
+import threading
+import time
 import json
+import orjson
 import logging
 from typing import Dict, List, Any
 import plotly.express as px
 import plotly.graph_objects as go
-import plotly.utils
 from datetime import datetime, timedelta
+from collections import OrderedDict, deque
 import re
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Query classes in priority order, with the keywords that select them
+QUERY_CLASSES = {
+    'chart': ['chart', 'graph', 'plot', 'visualize'],
+    'analysis': ['analyze', 'insight', 'trend'],
+    'aggregation': ['count', 'total', 'sum'],
+    'mapping': ['map', 'mapping', 'sku'],
+}
+
+# One named group per class inside a lookahead, so overlapping keywords are all found in a single scan
+QUERY_CLASS_PATTERN = re.compile('(?=' + '|'.join(
+    f"(?P<{query_class}>{'|'.join(map(re.escape, keywords))})"
+    for query_class, keywords in QUERY_CLASSES.items()
+) + ')')
+
+# Cheap check before trying to decode any JSON from a response
+CHART_TYPE_PATTERN = re.compile(r'"chart_type"\s*:')
+JSON_DECODER = json.JSONDecoder()
+
+# Defaults are OpenAI's usage tier 1 limits for gpt-4. Each request reserves its prompt plus a
+# 1000-token completion budget, so 10,000 TPM allows about nine requests a minute; set these
+# to the account's tier to throttle less
+REQUESTS_PER_MINUTE = int(os.getenv('OPENAI_REQUESTS_PER_MINUTE', '500'))
+TOKENS_PER_MINUTE = int(os.getenv('OPENAI_TOKENS_PER_MINUTE', '10000'))
+
+JSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS
+
+def _json_default(obj):
+    """Fallback for values orjson cannot serialize natively"""
+    if isinstance(obj, np.ndarray):
+        # Object and other unsupported array dtypes
+        return obj.tolist()
+    if isinstance(obj, pd.Timestamp):
+        return obj.isoformat()
+    if obj is pd.NA or obj is pd.NaT:
+        return None
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+def dump_json(obj) -> bytes:
+    """Serialize to compact JSON bytes with orjson"""
+    return orjson.dumps(obj, default=_json_default, option=JSON_OPTIONS)
+
+def figure_json(fig) -> str:
+    """Serialize a Plotly figure to a JSON string"""
+    return dump_json(fig.to_dict()).decode()
+
+class RateLimiter:
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        """Initialize leaky-bucket throttle for OpenAI requests and tokens per minute"""
+        self.max_requests = requests_per_minute
+        self.max_tokens = tokens_per_minute
+        self.available_requests = requests_per_minute
+        self.available_tokens = tokens_per_minute
+        self.last_update = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _try_acquire(self, tokens: int) -> bool:
+        """Refill the buckets and consume capacity if enough is available"""
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self.last_update
+            self.last_update = now
+            
+            self.available_requests = min(self.max_requests, self.available_requests + elapsed * self.max_requests / 60)
+            self.available_tokens = min(self.max_tokens, self.available_tokens + elapsed * self.max_tokens / 60)
+            
+            # A single request larger than the bucket would otherwise wait forever
+            tokens = min(tokens, self.max_tokens)
+            if self.available_requests >= 1 and self.available_tokens >= tokens:
+                self.available_requests -= 1
+                self.available_tokens -= tokens
+                return True
+            return False
+    
+    async def acquire(self, tokens: int):
+        """Wait until a request of the given token size fits under the limits"""
+        while not self._try_acquire(tokens):
+            await asyncio.sleep(0.05)
+
 class AIQueryEngine:
-    def __init__(self, api_key: str = None):
+    def __init__(self, api_key: str = None, max_concurrent: int = 5,
+                 requests_per_minute: int = REQUESTS_PER_MINUTE, tokens_per_minute: int = TOKENS_PER_MINUTE,
+                 cache_size: int = 1024, cache_ttl: int = 3600):
         """Initialize AI Query Engine with OpenAI"""
         if api_key:
             openai.api_key = api_key
         else:
             # Try to get from environment
-            import os
             # api_key = os.getenv('OPENAI_API_KEY')
             if api_key:
                 openai.api_key = api_key
@@ -28,7 +115,13 @@ class AIQueryEngine:
                 logger.warning("No OpenAI API key provided")
         
         self.system_prompt = self._get_system_prompt()
-        self.conversation_history = []
+        self.conversation_history = deque(maxlen=12)  # Last 6 exchanges
+        self.max_concurrent = max_concurrent
+        self.max_retries = 5
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._response_cache = OrderedDict()
     
     def _get_system_prompt(self) -> str:
         """Get system prompt for AI assistant"""
@@ -54,56 +147,229 @@ class AIQueryEngine:
         
         Be helpful, accurate, and provide actionable insights."""
     
-    def query(self, user_query: str, data_context: Dict[str, pd.DataFrame] = None) -> Dict[str, Any]:
+    def query(self, user_query: str, data_context: Dict[str, pd.DataFrame] = None,
+              use_cache: bool = True) -> Dict[str, Any]:
         """Process natural language query and return response"""
         try:
-            # Prepare context
-            context = self._prepare_context(data_context)
+            cache_key = self._cache_key(user_query, data_context)
+            ai_response = self._get_cached_response(cache_key) if use_cache else None
             
-            # Build messages
-            messages = [
-                {"role": "system", "content": self.system_prompt},
-                {"role": "user", "content": f"Context: {context}\n\nUser Query: {user_query}"}
-            ]
+            if ai_response is None:
+                messages = self._build_messages(user_query, data_context)
+                
+                # Call OpenAI, retrying once with less history if the prompt is too long
+                try:
+                    response = self._create(messages)
+                except openai.error.InvalidRequestError as e:
+                    if e.code != 'context_length_exceeded':
+                        raise
+                    response = self._create(self._build_messages(user_query, data_context, history_size=2))
+                
+                ai_response = response.choices[0].message.content
+                self._cache_response(cache_key, ai_response)
             
-            # Add conversation history
-            if self.conversation_history:
-                messages.extend(self.conversation_history[-4:])  # Last 4 exchanges
+            return self._build_response(user_query, ai_response, data_context)
             
-            # Call OpenAI
-            response = openai.ChatCompletion.create(
-                model="gpt-4",
-                messages=messages,
-                max_tokens=1000,
-                temperature=0.3
-            )
+        except Exception as e:
+            logger.error(f"Error processing AI query: {e}")
+            return self._error_response(e)
+    
+    async def aquery(self, user_query: str, data_context: Dict[str, pd.DataFrame] = None,
+                     semaphore: asyncio.Semaphore = None, use_cache: bool = True) -> Dict[str, Any]:
+        """Process natural language query without blocking, throttled to the rate limits"""
+        try:
+            cache_key = self._cache_key(user_query, data_context)
+            ai_response = self._get_cached_response(cache_key) if use_cache else None
+            if ai_response is not None:
+                return self._build_response(user_query, ai_response, data_context)
             
-            ai_response = response.choices[0].message.content
+            messages = self._build_messages(user_query, data_context)
             
-            # Update conversation history
-            self.conversation_history.extend([
-                {"role": "user", "content": user_query},
-                {"role": "assistant", "content": ai_response}
-            ])
+            # Rough token estimate (~4 characters per token) plus the completion budget
+            estimated_tokens = sum(len(m['content']) for m in messages) // 4 + 1000
             
-            # Parse response for chart requests
-            chart_data = self._extract_chart_data(ai_response, data_context)
+            # Only rate-limit retries count as attempts; trimming the history happens at most once
+            attempt = 0
+            history_trimmed = False
+            while True:
+                await self.rate_limiter.acquire(estimated_tokens)
+                try:
+                    if semaphore:
+                        async with semaphore:
+                            response = await self._acreate(messages)
+                    else:
+                        response = await self._acreate(messages)
+                    break
+                except openai.error.RateLimitError:
+                    if attempt == self.max_retries:
+                        raise
+                    delay = 2 ** attempt + random.random()
+                    logger.warning(f"OpenAI rate limit hit, retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                except openai.error.InvalidRequestError as e:
+                    if e.code != 'context_length_exceeded' or history_trimmed:
+                        raise
+                    messages = self._build_messages(user_query, data_context, history_size=2)
+                    history_trimmed = True
             
-            return {
-                'response': ai_response,
-                'chart_data': chart_data,
-                'query_type': self._classify_query(user_query),
-                'timestamp': datetime.now().isoformat()
-            }
+            ai_response = response.choices[0].message.content
+            self._cache_response(cache_key, ai_response)
+            
+            return self._build_response(user_query, ai_response, data_context)
             
         except Exception as e:
             logger.error(f"Error processing AI query: {e}")
-            return {
-                'response': f"Sorry, I encountered an error: {str(e)}",
-                'chart_data': None,
-                'query_type': 'error',
-                'timestamp': datetime.now().isoformat()
-            }
+            return self._error_response(e)
+    
+    async def batch_query(self, user_queries: List[str], data_context: Dict[str, pd.DataFrame] = None,
+                          use_cache: bool = True) -> List[Dict[str, Any]]:
+        """Process several queries concurrently under the shared rate limits"""
+        semaphore = asyncio.Semaphore(self.max_concurrent)
+        return await asyncio.gather(*[self.aquery(q, data_context, semaphore, use_cache) for q in user_queries])
+    
+    async def query_batch(self, user_queries: List[str], data_context: Dict[str, pd.DataFrame] = None) -> List[Dict[str, Any]]:
+        """Answer several queries in one OpenAI request, falling back to one request per query"""
+        try:
+            context = self._prepare_context(data_context)
+            messages = [
+                {"role": "system", "content": self.system_prompt},
+                {"role": "user", "content": (
+                    f"Context: {context}\n\n"
+                    f"Answer each of the following {len(user_queries)} user queries separately. "
+                    "Respond only with a JSON array of strings, one answer per query, in the same order.\n\n"
+                    f"User Queries: {json.dumps(user_queries)}"
+                )}
+            ]
+            max_tokens = min(1000 * len(user_queries), 4000)
+            
+            await self.rate_limiter.acquire(sum(len(m['content']) for m in messages) // 4 + max_tokens)
+            response = await self._acreate(messages, max_tokens=max_tokens)
+            answers = self._parse_batch_answers(response.choices[0].message.content, len(user_queries))
+            
+        except Exception as e:
+            logger.warning(f"Batched AI query failed: {e}")
+            answers = None
+        
+        if answers is None:
+            logger.info("Falling back to one AI request per query")
+            return await self.batch_query(user_queries, data_context)
+        
+        return [self._build_response(q, a, data_context) for q, a in zip(user_queries, answers)]
+    
+    def _parse_batch_answers(self, ai_response: str, expected: int) -> List[str]:
+        """Parse a JSON array holding one answer string per query, or None if it does not fit"""
+        start = ai_response.find('[')
+        if start == -1:
+            return None
+        
+        try:
+            answers, _ = JSON_DECODER.raw_decode(ai_response, start)
+        except ValueError:
+            return None
+        
+        if not isinstance(answers, list) or len(answers) != expected or not all(isinstance(a, str) for a in answers):
+            return None
+        return answers
+    
+    def _create(self, messages: List[Dict[str, str]]):
+        """Call the OpenAI chat completion endpoint"""
+        return openai.ChatCompletion.create(
+            model="gpt-4",
+            messages=messages,
+            max_tokens=1000,
+            temperature=0.3
+        )
+    
+    async def _acreate(self, messages: List[Dict[str, str]], max_tokens: int = 1000):
+        """Call the OpenAI chat completion endpoint asynchronously"""
+        return await openai.ChatCompletion.acreate(
+            model="gpt-4",
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=0.3
+        )
+    
+    def _cache_key(self, user_query: str, data_context: Dict[str, pd.DataFrame]) -> str:
+        """Hash the prompt inputs, describing tables by shape and columns only"""
+        context_sig = [
+            (table_name, df.shape, [str(col) for col in df.columns])
+            for table_name, df in (data_context or {}).items()
+            if df is not None
+        ]
+        payload = (
+            self.system_prompt
+            + json.dumps(list(self.conversation_history)[-4:])
+            + user_query
+            + json.dumps(context_sig)
+        )
+        return hashlib.blake2b(payload.encode()).hexdigest()
+    
+    def _get_cached_response(self, cache_key: str) -> str:
+        """Return a cached AI response that has not expired"""
+        entry = self._response_cache.get(cache_key)
+        if entry is None:
+            return None
+        
+        ai_response, cached_at = entry
+        if time.monotonic() - cached_at > self.cache_ttl:
+            self._response_cache.pop(cache_key, None)
+            return None
+        
+        self._response_cache.move_to_end(cache_key)
+        return ai_response
+    
+    def _cache_response(self, cache_key: str, ai_response: str):
+        """Store an AI response, evicting the least recently used entries"""
+        self._response_cache[cache_key] = (ai_response, time.monotonic())
+        self._response_cache.move_to_end(cache_key)
+        while len(self._response_cache) > self.cache_size:
+            self._response_cache.popitem(last=False)
+    
+    def _build_messages(self, user_query: str, data_context: Dict[str, pd.DataFrame],
+                        history_size: int = 4) -> List[Dict[str, str]]:
+        """Build the chat messages for a query"""
+        # Prepare context
+        context = self._prepare_context(data_context)
+        
+        # Build messages
+        messages = [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": f"Context: {context}\n\nUser Query: {user_query}"}
+        ]
+        
+        # Add conversation history
+        if self.conversation_history:
+            messages.extend(list(self.conversation_history)[-history_size:])
+        
+        return messages
+    
+    def _build_response(self, user_query: str, ai_response: str, data_context: Dict[str, pd.DataFrame]) -> Dict[str, Any]:
+        """Record the exchange and build the query result"""
+        # Update conversation history
+        self.conversation_history.extend([
+            {"role": "user", "content": user_query},
+            {"role": "assistant", "content": ai_response}
+        ])
+        
+        # Parse response for chart requests
+        chart_data = self._extract_chart_data(ai_response, data_context)
+        
+        return {
+            'response': ai_response,
+            'chart_data': chart_data,
+            'query_type': self._classify_query(user_query),
+            'timestamp': datetime.now().isoformat()
+        }
+    
+    def _error_response(self, error: Exception) -> Dict[str, Any]:
+        """Build the result returned when a query fails"""
+        return {
+            'response': f"Sorry, I encountered an error: {str(error)}",
+            'chart_data': None,
+            'query_type': 'error',
+            'timestamp': datetime.now().isoformat()
+        }
     
     def _prepare_context(self, data_context: Dict[str, pd.DataFrame]) -> str:
         """Prepare data context for AI"""
@@ -115,34 +381,22 @@ class AIQueryEngine:
         for table_name, df in data_context.items():
             if df is not None and not df.empty:
                 context_parts.append(f"{table_name}:")
-                context_parts.append(f"- Columns: {list(df.columns)}")
+                context_parts.append(f"- Columns: {df.dtypes.astype(str).to_dict()}")
                 context_parts.append(f"- Rows: {len(df)}")
-                context_parts.append(f"- Sample data: {df.head(3).to_dict('records')}")
         
         return "\n".join(context_parts)
     
     def _classify_query(self, query: str) -> str:
         """Classify the type of query"""
-        query_lower = query.lower()
-        
-        if any(word in query_lower for word in ['chart', 'graph', 'plot', 'visualize']):
-            return 'chart'
-        elif any(word in query_lower for word in ['analyze', 'insight', 'trend']):
-            return 'analysis'
-        elif any(word in query_lower for word in ['count', 'total', 'sum']):
-            return 'aggregation'
-        elif any(word in query_lower for word in ['map', 'mapping', 'sku']):
-            return 'mapping'
-        else:
-            return 'general'
+        found = {match.lastgroup for match in QUERY_CLASS_PATTERN.finditer(query.lower())}
+        return next((query_class for query_class in QUERY_CLASSES if query_class in found), 'general')
     
     def _extract_chart_data(self, ai_response: str, data_context: Dict[str, pd.DataFrame]) -> Dict[str, Any]:
         """Extract chart data from AI response"""
         try:
             # Look for JSON chart data in response
-            json_match = re.search(r'\{.*"chart_type".*\}', ai_response, re.DOTALL)
-            if json_match:
-                chart_data = json.loads(json_match.group())
+            chart_data = self._find_chart_json(ai_response)
+            if chart_data:
                 return self._generate_chart(chart_data, data_context)
             
             # If no JSON found, try to infer chart from query
@@ -152,6 +406,24 @@ class AIQueryEngine:
             logger.error(f"Error extracting chart data: {e}")
             return None
     
+    def _find_chart_json(self, text: str) -> Dict[str, Any]:
+        """Decode the first JSON object in text that has a chart_type key"""
+        if not CHART_TYPE_PATTERN.search(text):
+            return None
+        
+        start = text.find('{')
+        while start != -1:
+            try:
+                obj, _ = JSON_DECODER.raw_decode(text, start)
+                if isinstance(obj, dict) and 'chart_type' in obj:
+                    return obj
+            except ValueError:
+                pass
+            # Not a chart object; it may still contain one further in
+            start = text.find('{', start + 1)
+        
+        return None
+    
     def _generate_chart(self, chart_data: Dict[str, Any], data_context: Dict[str, pd.DataFrame]) -> Dict[str, Any]:
         """Generate chart using plotly based on AI specifications"""
         try:
@@ -175,21 +447,22 @@ class AIQueryEngine:
             
             elif chart_type == 'pie':
                 # Mapping status chart
-                mapping_status = df['MSKU'].apply(lambda x: 'Mapped' if x != 'Unmapped' else 'Unmapped').value_counts()
+                mapped = int((df['MSKU'] != 'Unmapped').sum())
                 fig = px.pie(
-                    values=mapping_status.values,
-                    names=mapping_status.index,
+                    values=[mapped, len(df) - mapped],
+                    names=['Mapped', 'Unmapped'],
                     title=title
                 )
             
             elif chart_type == 'line':
                 # Time series chart
-                if 'Date' in df.columns:
-                    df['Date'] = pd.to_datetime(df['Date'])
-                    daily_sales = df.groupby(df['Date'].dt.date).size()
+                if 'Date' in df.columns and df['Date'].dtype.kind == 'M':
+                    # Daily histogram over the already-parsed dates
+                    days = df['Date'].to_numpy(dtype='datetime64[D]', na_value=np.datetime64('NaT'))
+                    dates, counts = np.unique(days[~np.isnat(days)], return_counts=True)
                     fig = px.line(
-                        x=daily_sales.index,
-                        y=daily_sales.values,
+                        x=dates,
+                        y=counts,
                         title=title,
                         labels={'x': 'Date', 'y': 'Orders'}
                     )
@@ -200,7 +473,7 @@ class AIQueryEngine:
                 return None
             
             return {
-                'chart_json': json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder),
+                'chart_json': figure_json(fig),
                 'chart_type': chart_type,
                 'title': title
             }
@@ -214,28 +487,29 @@ class AIQueryEngine:
         try:
             analysis = {
                 'total_records': len(df),
-                'unique_products': df['MSKU'].nunique() if 'MSKU' in df.columns else 0,
+                'unique_products': 0,
                 'mapping_rate': 0,
                 'top_products': {},
                 'data_quality': {}
             }
             
-            # Calculate mapping rate
+            # Product stats and mapping rate from a single count pass
             if 'MSKU' in df.columns:
-                mapped_count = len(df[df['MSKU'] != 'Unmapped'])
+                product_counts = df['MSKU'].value_counts()
+                mapped_count = len(df) - int(product_counts.get('Unmapped', 0))
+                analysis['unique_products'] = product_counts.size
                 analysis['mapping_rate'] = (mapped_count / len(df)) * 100
-                analysis['top_products'] = df['MSKU'].value_counts().head(5).to_dict()
+                analysis['top_products'] = product_counts.head(5).to_dict()
             
             # Data quality checks
             analysis['data_quality'] = {
-                'missing_values': df.isnull().sum().to_dict(),
-                'duplicate_records': len(df[df.duplicated()]),
+                'missing_values': df.isna().sum().to_dict(),
+                'duplicate_records': int(df.duplicated().sum()),
                 'date_range': None
             }
             
-            if 'Date' in df.columns:
+            if 'Date' in df.columns and df['Date'].dtype.kind == 'M':
                 try:
-                    df['Date'] = pd.to_datetime(df['Date'])
                     analysis['data_quality']['date_range'] = {
                         'start': df['Date'].min().strftime('%Y-%m-%d'),
                         'end': df['Date'].max().strftime('%Y-%m-%d')
@@ -255,19 +529,20 @@ class AIQueryEngine:
         
         try:
             if 'MSKU' in df.columns:
+                product_counts = df['MSKU'].value_counts()
+                
                 # Mapping insights
-                mapping_rate = (len(df[df['MSKU'] != 'Unmapped']) / len(df)) * 100
+                mapping_rate = ((len(df) - int(product_counts.get('Unmapped', 0))) / len(df)) * 100
                 if mapping_rate < 90:
                     insights.append(f"⚠️ Only {mapping_rate:.1f}% of SKUs are mapped. Consider updating your mapping file.")
                 
                 # Top product insights
-                top_product = df['MSKU'].value_counts().index[0]
-                top_count = df['MSKU'].value_counts().iloc[0]
+                top_product = product_counts.index[0]
+                top_count = product_counts.iloc[0]
                 insights.append(f"🏆 {top_product} is your top-selling product with {top_count} orders.")
             
-            if 'Date' in df.columns:
+            if 'Date' in df.columns and df['Date'].dtype.kind == 'M':
                 try:
-                    df['Date'] = pd.to_datetime(df['Date'])
                     recent_date = df['Date'].max()
                     days_ago = (datetime.now() - recent_date).days
                     if days_ago > 7:
@@ -297,7 +572,7 @@ if __name__ == "__main__":
             'SKU': ['SKU001', 'SKU002', 'SKU001'],
             'MSKU': ['MSKU001', 'MSKU002', 'MSKU001'],
             'Quantity': [2, 1, 3],
-            'Date': ['2024-01-01', '2024-01-02', '2024-01-03']
+            'Date': pd.to_datetime(['2024-01-01', '2024-01-02', '2024-01-03'])
         })
     }
     
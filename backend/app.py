@@ -1,70 +1,203 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 import pandas as pd
 import os
-import json
 import logging
 from datetime import datetime
-import tempfile
+import asyncio
 from werkzeug.utils import secure_filename
-from fuzzywuzzy import process
+from rapidfuzz import process, fuzz, utils
+import numpy as np
+import orjson
 import plotly.express as px
-import plotly.graph_objects as go
-import plotly.utils
 import io
-import base64
+from ai.text_to_sql import AIQueryEngine, dump_json, figure_json
+import fuzzy_numba
+from file_io import EXPORT_CHUNK_ROWS, dates_as_text, read_table, write_excel
+import storage
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class OrjsonProvider(JSONProvider):
+    """Serve jsonify responses and parse request bodies with orjson"""
+    
+    def dumps(self, obj, **kwargs):
+        return dump_json(obj).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dump_json(obj), mimetype='application/json')
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
 # Global variables
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'csv', 'xlsx', 'json'}
+FUZZY_MATCH_THRESHOLD = 80
+# Above this many SKU pairs, skip the full score matrix and use the numba matcher
+NUMBA_MATCH_MIN_PAIRS = 1e8
+# Length of the SKU prefix used to narrow fuzzy candidates on large catalogs
+FUZZY_PREFIX_LENGTH = 3
+DATE_FORMAT = '%Y-%m-%d'
+MAX_AI_BATCH_QUERIES = 20
 
 # Ensure upload folder exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# In-memory storage (in production, use database)
-mapping_data = {}
-sales_data = {}
-processed_data = {}
+# Datasets live in Parquet files tracked by storage; these are per-worker caches
+mapping_index_cache = {}
+analytics_cache = {}
+ai_sales_cache = {}
+
+ai_engine = AIQueryEngine()
+
+def parse_dates(values):
+    """Parse date text, trying DATE_FORMAT first and inferring the format for the rest; unparseable values become NaT"""
+    parsed = pd.to_datetime(values, format=DATE_FORMAT, errors='coerce', cache=True)
+    retry = parsed.isna() & values.notna()
+    if retry.any():
+        parsed[retry] = pd.to_datetime(values[retry], format='mixed', errors='coerce', cache=True)
+    return parsed
+
+def get_sales_context():
+    """Get the current sales frame for the AI engine, parsing its dates once per stored dataset"""
+    for name in ('processed', 'sales'):
+        dataset = storage.get_dataset(name)
+        if dataset is not None:
+            break
+    else:
+        return None
+    
+    if dataset['path'] not in ai_sales_cache:
+        df = storage.load_dataset(name)
+        # The stored column keeps the user's text; only this view gets typed dates
+        if 'Date' in df.columns:
+            df = df.assign(Date=parse_dates(df['Date']))
+        ai_sales_cache.clear()
+        ai_sales_cache[dataset['path']] = df
+    return ai_sales_cache[dataset['path']]
+
+def get_data_context():
+    """Collect the current DataFrames for the AI engine"""
+    return {
+        'sales_data': get_sales_context(),
+        'mapping_data': storage.load_dataset('mapping')
+    }
+
+def build_mapping_index(df):
+    """Build the normalized SKU lookup plus sorted key and MSKU arrays for fuzzy matching"""
+    sku_to_msku = {str(k).strip().upper(): v for k, v in zip(df['SKU'], df['MSKU']) if pd.notna(k)}
+    keys = np.array(sorted(sku_to_msku), dtype=str)
+    
+    return {
+        'sku_to_msku': sku_to_msku,
+        'keys': keys,
+        'mskus': np.array([sku_to_msku[k] for k in keys], dtype=object)
+    }
+
+def get_mapping_index(mapping):
+    """Get the index for a stored mapping dataset, building it once per worker"""
+    if mapping['path'] not in mapping_index_cache:
+        mapping_index_cache.clear()
+        mapping_index_cache[mapping['path']] = build_mapping_index(storage.load_dataset('mapping'))
+    return mapping_index_cache[mapping['path']]
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 def load_file(file_path):
-    """Load file based on extension"""
+    """Load an uploaded file, with dates as text and blanks in text columns"""
+    df = read_table(file_path)
     if file_path.endswith('.json'):
-        with open(file_path, 'r') as f:
-            data = json.load(f)
-        return pd.DataFrame(data)
-    elif file_path.endswith('.csv'):
-        return pd.read_csv(file_path).fillna('')
-    else:
-        return pd.read_excel(file_path).fillna('')
+        return df
+    
+    # Excel dates become text too, like CSV dates
+    df = dates_as_text(df)
+    
+    # Only text columns get blanks; numeric nulls stay missing
+    string_columns = [col for col in df.columns if pd.api.types.is_string_dtype(df[col])]
+    return df.fillna({col: '' for col in string_columns})
+
+def format_dates(df):
+    """Render datetime columns as date strings for JSON and file exports"""
+    date_columns = [col for col in df.columns if df[col].dtype.kind == 'M']
+    if not date_columns:
+        return df
+    return df.assign(**{col: df[col].dt.strftime(DATE_FORMAT) for col in date_columns})
+
+def to_records(df):
+    """Convert rows to JSON-safe dicts with missing values as null"""
+    df = format_dates(df)
+    return df.astype(object).where(df.notna(), None).to_dict('records')
 
-def map_sku(sku, sku_to_msku):
-    """Map SKU to MSKU with fuzzy matching"""
-    if pd.isna(sku):
-        return "Unmapped"
+def match_by_prefix(queries, keys):
+    """Best fuzzy match per query among the sorted keys sharing its prefix, -1 if none"""
+    best = np.full(len(queries), -1, dtype=np.int64)
+    prefixes = [q[:FUZZY_PREFIX_LENGTH] for q in queries]
     
-    sku_str = str(sku).strip().upper()
+    for prefix, positions in pd.Series(prefixes).groupby(prefixes).indices.items():
+        # Keys with this prefix form one contiguous run of the sorted array
+        lo = np.searchsorted(keys, prefix, side='left')
+        hi = np.searchsorted(keys, prefix + '\U0010ffff', side='left')
+        if lo == hi:
+            continue
+        
+        scores = process.cdist(
+            queries[positions],
+            keys[lo:hi],
+            scorer=fuzz.WRatio,
+            processor=utils.default_process,
+            score_cutoff=FUZZY_MATCH_THRESHOLD,
+            workers=-1
+        )
+        candidate = scores.argmax(axis=1)
+        matched = scores[np.arange(len(positions)), candidate] >= FUZZY_MATCH_THRESHOLD
+        best[positions[matched]] = lo + candidate[matched]
+    
+    return best
+
+def map_skus(skus, mapping_index):
+    """Map a column of SKUs to MSKUs, fuzzy matching each unique miss once"""
+    sku_to_msku = mapping_index['sku_to_msku']
+    keys = mapping_index['keys']
+    normalized = skus.astype('string').str.strip().str.upper()
     
     # Direct mapping
-    if sku_str in sku_to_msku:
-        return sku_to_msku[sku_str]
+    msku = normalized.map(sku_to_msku)
+    remaining = np.asarray(normalized[msku.isna() & normalized.notna()].unique(), dtype=str)
     
-    # Fuzzy matching
-    if len(sku_to_msku) > 0:
-        best_match = process.extractOne(sku_str, sku_to_msku.keys())
-        if best_match and best_match[1] >= 80:
-            return sku_to_msku[best_match[0]]
+    # Fuzzy matching, one pass for all remaining SKUs
+    if len(remaining) > 0 and len(keys) > 0:
+        if len(remaining) * len(keys) > NUMBA_MATCH_MIN_PAIRS:
+            # Score same-prefix keys first, then trigram-scan the whole catalog for the rest
+            best = match_by_prefix(remaining, keys)
+            unresolved = best < 0
+            if unresolved.any():
+                best[unresolved] = fuzzy_numba.match_strings(remaining[unresolved], keys, FUZZY_MATCH_THRESHOLD / 100)
+        else:
+            scores = process.cdist(
+                remaining,
+                keys,
+                scorer=fuzz.WRatio,
+                processor=utils.default_process,
+                score_cutoff=FUZZY_MATCH_THRESHOLD,
+                workers=-1
+            )
+            best = scores.argmax(axis=1)
+            best[scores[np.arange(len(remaining)), best] < FUZZY_MATCH_THRESHOLD] = -1
+        matched = best >= 0
+        fuzzy_matches = dict(zip(remaining[matched], mapping_index['mskus'][best[matched]]))
+        msku = msku.fillna(normalized.map(fuzzy_matches))
     
-    return "Unmapped"
+    return msku.fillna("Unmapped")
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
@@ -103,9 +236,9 @@ def upload_mapping():
             return jsonify({'error': f'Missing required columns: {required_cols}'}), 400
         
         # Store mapping data
-        mapping_data['df'] = df
-        mapping_data['sku_to_msku'] = dict(zip(df['SKU'], df['MSKU']))
-        mapping_data['file_path'] = file_path
+        path = storage.save_dataset('mapping', df)
+        mapping_index_cache.clear()
+        mapping_index_cache[path] = build_mapping_index(df)
         
         logger.info(f"Mapping file uploaded: {filename}, {len(df)} mappings")
         
@@ -142,8 +275,7 @@ def upload_sales():
         df = load_file(file_path)
         
         # Store sales data
-        sales_data['df'] = df
-        sales_data['file_path'] = file_path
+        storage.save_dataset('sales', df)
         
         logger.info(f"Sales file uploaded: {filename}, {len(df)} records")
         
@@ -161,11 +293,13 @@ def upload_sales():
 def process_mapping():
     """Process SKU mapping on sales data"""
     try:
-        if not mapping_data or not sales_data:
+        mapping = storage.get_dataset('mapping')
+        if mapping is None or storage.get_dataset('sales') is None:
             return jsonify({'error': 'Please upload both mapping and sales files first'}), 400
         
-        df = sales_data['df'].copy()
-        sku_to_msku = mapping_data['sku_to_msku']
+        # Shallow copy: sales columns are shared, only MSKU is new
+        df = storage.load_dataset('sales').copy(deep=False)
+        mapping_index = get_mapping_index(mapping)
         
         # Find SKU column
         sku_column = None
@@ -177,30 +311,31 @@ def process_mapping():
         if sku_column is None:
             return jsonify({'error': 'No SKU column found in sales data'}), 400
         
-        # Apply mapping
-        df['MSKU'] = df[sku_column].apply(lambda x: map_sku(x, sku_to_msku))
+        # Apply mapping, keeping the repeated MSKU strings as category codes
+        df['MSKU'] = map_skus(df[sku_column], mapping_index).astype('category')
         
-        # Calculate statistics
+        # Calculate statistics; comparing a categorical compares its integer codes
         total_records = len(df)
-        mapped_records = len(df[df['MSKU'] != 'Unmapped'])
-        unmapped_skus = df[df['MSKU'] == 'Unmapped'][sku_column].unique().tolist()
+        unmapped_mask = (df['MSKU'] == 'Unmapped').to_numpy()
+        mapped_records = total_records - int(unmapped_mask.sum())
+        unmapped_skus = df.loc[unmapped_mask, sku_column].dropna().unique().tolist()
         
         # Store processed data
-        processed_data['df'] = df
-        processed_data['stats'] = {
+        stats = {
             'total_records': total_records,
             'mapped_records': mapped_records,
             'mapping_rate': mapped_records / total_records * 100,
             'unmapped_skus': unmapped_skus,
             'unmapped_count': len(unmapped_skus)
         }
+        storage.save_dataset('processed', df, info=stats)
         
         logger.info(f"Mapping processed: {mapped_records}/{total_records} records mapped")
         
         return jsonify({
             'message': 'Mapping processed successfully',
-            'stats': processed_data['stats'],
-            'preview': df.head(10).to_dict('records')
+            'stats': stats,
+            'preview': to_records(df.head(10))
         })
         
     except Exception as e:
@@ -211,39 +346,48 @@ def process_mapping():
 def export_results():
     """Export processed results"""
     try:
-        if not processed_data:
+        processed = storage.get_dataset('processed')
+        if processed is None:
             return jsonify({'error': 'No processed data to export'}), 400
         
         data = request.get_json()
         format_type = data.get('format', 'csv')
         
-        df = processed_data['df']
+        df = storage.load_dataset('processed')
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         
         if format_type == 'csv':
-            # Create CSV in memory
-            output = io.StringIO()
-            df.to_csv(output, index=False)
-            output.seek(0)
+            # Stream CSV in row chunks instead of building the whole file in memory
+            def generate():
+                for start in range(0, max(len(df), 1), EXPORT_CHUNK_ROWS):
+                    yield format_dates(df.iloc[start:start + EXPORT_CHUNK_ROWS]).to_csv(header=start == 0, index=False)
             
-            return send_file(
-                io.BytesIO(output.getvalue().encode('utf-8')),
+            return Response(
+                generate(),
                 mimetype='text/csv',
-                as_attachment=True,
-                download_name=f'processed_sales_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
+                headers={'Content-Disposition': f'attachment; filename=processed_sales_{timestamp}.csv'}
             )
         
         elif format_type == 'excel':
-            # Create Excel in memory
+            # Create Excel with rows flushed as they are written
             output = io.BytesIO()
-            with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                df.to_excel(writer, index=False, sheet_name='Processed Data')
+            write_excel(df, output, sheet_name='Processed Data')
             output.seek(0)
             
             return send_file(
                 output,
                 mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
                 as_attachment=True,
-                download_name=f'processed_sales_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
+                download_name=f'processed_sales_{timestamp}.xlsx'
+            )
+        
+        elif format_type == 'parquet':
+            # The stored dataset is already a zstd-compressed Parquet file
+            return send_file(
+                os.path.abspath(processed['path']),
+                mimetype='application/vnd.apache.parquet',
+                as_attachment=True,
+                download_name=f'processed_sales_{timestamp}.parquet'
             )
         
         else:
@@ -257,70 +401,105 @@ def export_results():
 def get_analytics():
     """Get analytics and charts"""
     try:
-        if not processed_data:
+        processed = storage.get_dataset('processed')
+        if processed is None:
             return jsonify({'error': 'No processed data available'}), 400
         
-        df = processed_data['df']
+        # Analytics only change when /api/process writes a new dataset
+        version = processed['path']
+        if version in analytics_cache:
+            return jsonify(analytics_cache[version])
+        
+        # One aggregation pass in DuckDB straight over the Parquet file
+        product_counts = storage.query(
+            'SELECT MSKU, COUNT(*) AS orders FROM read_parquet(?) GROUP BY MSKU ORDER BY orders DESC, MSKU',
+            [processed['path']]
+        )
+        top_products = product_counts.head(10)
         
         # Basic analytics
         analytics = {
-            'total_orders': len(df),
-            'unique_products': df['MSKU'].nunique(),
-            'mapping_rate': processed_data['stats']['mapping_rate'],
-            'top_products': df['MSKU'].value_counts().head(10).to_dict(),
-            'unmapped_count': processed_data['stats']['unmapped_count']
+            'total_orders': processed['rows'],
+            'unique_products': len(product_counts),
+            'mapping_rate': processed['info']['mapping_rate'],
+            'top_products': dict(zip(top_products['MSKU'], top_products['orders'].tolist())),
+            'unmapped_count': processed['info']['unmapped_count']
         }
         
         # Generate charts
         charts = {}
         
         # Top products chart
-        top_products = df['MSKU'].value_counts().head(10)
         fig = px.bar(
-            x=top_products.values,
-            y=top_products.index,
+            x=top_products['orders'],
+            y=top_products['MSKU'],
             orientation='h',
             title='Top 10 Products by Orders',
             labels={'x': 'Number of Orders', 'y': 'MSKU'}
         )
-        charts['top_products'] = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+        charts['top_products'] = figure_json(fig)
         
         # Mapping status pie chart
-        mapping_status = df['MSKU'].apply(lambda x: 'Mapped' if x != 'Unmapped' else 'Unmapped').value_counts()
+        mapped = int(product_counts.loc[product_counts['MSKU'] != 'Unmapped', 'orders'].sum())
         fig = px.pie(
-            values=mapping_status.values,
-            names=mapping_status.index,
+            values=[mapped, processed['rows'] - mapped],
+            names=['Mapped', 'Unmapped'],
             title='Mapping Status Distribution'
         )
-        charts['mapping_status'] = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+        charts['mapping_status'] = figure_json(fig)
         
-        return jsonify({
+        analytics_cache.clear()
+        analytics_cache[version] = {
             'analytics': analytics,
             'charts': charts
-        })
+        }
+        
+        return jsonify(analytics_cache[version])
         
     except Exception as e:
         logger.error(f"Error generating analytics: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/ai/batch', methods=['POST'])
+def ai_batch_query():
+    """Answer several natural language queries in one AI round trip"""
+    try:
+        data = request.get_json() or {}
+        queries = data.get('queries')
+        
+        if not isinstance(queries, list) or not queries:
+            return jsonify({'error': 'No queries provided'}), 400
+        
+        if len(queries) > MAX_AI_BATCH_QUERIES:
+            return jsonify({'error': f'At most {MAX_AI_BATCH_QUERIES} queries per batch'}), 400
+        
+        if not all(isinstance(q, str) and q.strip() for q in queries):
+            return jsonify({'error': 'Each query must be a non-empty string'}), 400
+        
+        responses = asyncio.run(ai_engine.query_batch(queries, get_data_context()))
+        
+        return jsonify({'responses': responses})
+        
+    except Exception as e:
+        logger.error(f"Error processing AI batch query: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/data/preview', methods=['GET'])
 def get_data_preview():
     """Get preview of current data"""
     try:
         data_type = request.args.get('type', 'sales')
         
-        if data_type == 'mapping' and mapping_data:
-            df = mapping_data['df']
-        elif data_type == 'sales' and sales_data:
-            df = sales_data['df']
-        elif data_type == 'processed' and processed_data:
-            df = processed_data['df']
-        else:
+        df = None
+        if data_type in ('mapping', 'sales', 'processed'):
+            df = storage.load_dataset(data_type)
+        
+        if df is None:
             return jsonify({'error': 'No data available'}), 400
         
         return jsonify({
             'columns': list(df.columns),
-            'preview': df.head(20).to_dict('records'),
+            'preview': to_records(df.head(20)),
             'total_rows': len(df)
         })
         
@@ -0,0 +1,60 @@
+import logging
+import orjson
+import pandas as pd
+import pyarrow as pa
+import xlsxwriter
+
+logger = logging.getLogger(__name__)
+
+EXPORT_CHUNK_ROWS = 50000
+
+def read_table(file_path):
+    """Load a CSV, Excel or JSON file into Arrow-backed columns"""
+    if file_path.endswith('.json'):
+        with open(file_path, 'rb') as f:
+            return pd.DataFrame(orjson.loads(f.read()))
+    
+    if file_path.endswith('.csv'):
+        try:
+            # Multithreaded Arrow parser
+            df = pd.read_csv(file_path, engine='pyarrow', dtype_backend='pyarrow')
+            # Header-only read gives the same de-duplicated names as the default parser
+            df.columns = pd.read_csv(file_path, nrows=0).columns
+        except ValueError as e:
+            # pyarrow infers types from the first block and fails on later mismatches
+            logger.warning(f"Falling back to default CSV parser: {e}")
+            df = pd.read_csv(file_path, dtype_backend='pyarrow')
+        return dates_as_text(df)
+    
+    try:
+        return pd.read_excel(file_path, engine='calamine', dtype_backend='pyarrow')
+    except (ImportError, ValueError) as e:
+        logger.warning(f"Falling back to default Excel reader: {e}")
+        return pd.read_excel(file_path, dtype_backend='pyarrow')
+
+def dates_as_text(df):
+    """Turn Arrow date and time columns back into strings, as the default CSV parser reads them"""
+    temporal = [
+        col for col in df.columns
+        if isinstance(df[col].dtype, pd.ArrowDtype) and pa.types.is_temporal(df[col].dtype.pyarrow_dtype)
+    ]
+    if not temporal:
+        return df
+    return df.astype({col: pd.ArrowDtype(pa.string()) for col in temporal})
+
+def write_excel(df, output, sheet_name=None):
+    """Write rows in order to a path or buffer in xlsxwriter's constant-memory mode"""
+    # Rows are flushed as they are written; to_excel writes column by column,
+    # which constant_memory mode cannot handle
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd'})
+    worksheet = workbook.add_worksheet(sheet_name)
+    worksheet.write_row(0, 0, [str(col) for col in df.columns])
+    
+    row_num = 1
+    for start in range(0, len(df), EXPORT_CHUNK_ROWS):
+        chunk = df.iloc[start:start + EXPORT_CHUNK_ROWS]
+        for values in chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None):
+            worksheet.write_row(row_num, 0, values)
+            row_num += 1
+    
+    workbook.close()
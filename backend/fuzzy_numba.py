@@ -0,0 +1,67 @@
+import numpy as np
+from numba import njit, prange
+
+# Trigram signatures are packed into SIGNATURE_WORDS * 64 bits
+SIGNATURE_WORDS = 4
+SIGNATURE_BITS = SIGNATURE_WORDS * 64
+
+@njit(cache=True)
+def _popcount(x):
+    """Count set bits in a uint64"""
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+@njit(parallel=True, cache=True)
+def signatures(codes, lengths):
+    """Hash each string's character trigrams into a packed bitset"""
+    n = codes.shape[0]
+    out = np.zeros((n, SIGNATURE_WORDS), dtype=np.uint64)
+    for i in prange(n):
+        length = lengths[i]
+        # Strings shorter than a trigram are hashed whole
+        grams = max(length - 2, 1)
+        for start in range(grams):
+            h = np.uint64(14695981039346656037)
+            for k in range(start, min(start + 3, length)):
+                h = (h ^ np.uint64(codes[i, k])) * np.uint64(1099511628211)
+            bit = h % np.uint64(SIGNATURE_BITS)
+            out[i, bit >> np.uint64(6)] |= np.uint64(1) << (bit & np.uint64(63))
+    return out
+
+@njit(parallel=True, cache=True)
+def best_match(query_codes, key_codes, threshold):
+    """Index of the key signature with the highest trigram Jaccard per query, -1 below threshold"""
+    n = query_codes.shape[0]
+    m = key_codes.shape[0]
+    best = np.full(n, -1, dtype=np.int64)
+    for i in prange(n):
+        best_score = -1.0
+        best_index = -1
+        for j in range(m):
+            inter = np.uint64(0)
+            union = np.uint64(0)
+            for w in range(SIGNATURE_WORDS):
+                inter += _popcount(query_codes[i, w] & key_codes[j, w])
+                union += _popcount(query_codes[i, w] | key_codes[j, w])
+            score = inter / union if union > 0 else 0.0
+            if score > best_score:
+                best_score = score
+                best_index = j
+        if best_score >= threshold:
+            best[i] = best_index
+    return best
+
+def encode(strings):
+    """Encode strings as int32 code points padded to a matrix, plus their lengths"""
+    arr = np.array(list(strings), dtype=str)
+    lengths = np.char.str_len(arr).astype(np.int64)
+    codes = arr.view(np.int32).reshape(len(arr), -1)
+    return codes, lengths
+
+def match_strings(queries, keys, threshold):
+    """For each query, the index into keys of its best trigram match, or -1"""
+    query_codes = signatures(*encode(queries))
+    key_codes = signatures(*encode(keys))
+    return best_match(query_codes, key_codes, threshold)
@@ -2,16 +2,28 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import customtkinter as ctk
 import pandas as pd
+import numpy as np
 import os
 import logging
-from fuzzywuzzy import process
-import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from rapidfuzz import process, fuzz, utils
+from file_io import read_table, write_excel
 from datetime import datetime
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+FUZZY_MATCH_THRESHOLD = 80
+NGRAM_SIZE = 3
+
+# Unmapped rows hold a missing MSKU and only show this label on screen and in exports
+UNMAPPED_LABEL = "Unmapped"
+
+# File reads and matching run here so the Tk main loop stays responsive
+executor = ThreadPoolExecutor(max_workers=2)
+
 class SKUMappingTool:
     def __init__(self):
         self.root = ctk.CTk()
@@ -21,8 +33,16 @@ class SKUMappingTool:
         # Initialize data
         self.mapping_df = None
         self.sales_df = None
-        self.sku_to_msku = {}
+        self.sku_to_msku_series = pd.Series(dtype=object)
         self.unmapped_skus = []
+        self._choice_keys = []
+        self._choice_keys_processed = []
+        self._ngram_index = {}
+        self._short_choices = set()
+        self._fuzzy_cache = {}
+        self._mapping_loading = False
+        self._sales_loading = False
+        self._processing = False
         
         self.setup_ui()
         
@@ -105,38 +125,71 @@ class SKUMappingTool:
         export_button.pack(anchor="w", padx=10, pady=5)
         
     def load_mapping_file(self):
+        if self._mapping_loading or self._processing:
+            messagebox.showwarning("Warning", "Please wait for the current operation to finish")
+            return
+        
         file_path = filedialog.askopenfilename(
             title="Select SKU Mapping File",
             filetypes=[("CSV files", "*.csv"), ("Excel files", "*.xlsx"), ("All files", "*.*")]
         )
         
         if file_path:
-            try:
-                if file_path.endswith('.csv'):
-                    self.mapping_df = pd.read_csv(file_path)
-                else:
-                    self.mapping_df = pd.read_excel(file_path)
-                
-                # Validate columns
-                required_cols = ['SKU', 'MSKU']
-                if not all(col in self.mapping_df.columns for col in required_cols):
-                    messagebox.showerror("Error", f"Mapping file must contain columns: {required_cols}")
-                    return
-                
-                # Create mapping dictionary
-                self.sku_to_msku = dict(zip(self.mapping_df['SKU'], self.mapping_df['MSKU']))
-                
-                # Update display
-                self.update_mapping_display()
-                
-                messagebox.showinfo("Success", f"Loaded {len(self.mapping_df)} SKU mappings")
-                logger.info(f"Loaded mapping file: {file_path}")
-                
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to load mapping file: {str(e)}")
-                logger.error(f"Error loading mapping file: {e}")
+            self._mapping_loading = True
+            self.stats_label.configure(text="📈 Statistics: Loading mapping file...")
+            self._run_in_background(
+                partial(self._read_mapping, file_path),
+                partial(self._on_mapping_loaded, file_path),
+                self._on_mapping_failed
+            )
+    
+    def _read_mapping(self, file_path):
+        mapping_df = read_table(file_path)
+        
+        # Validate columns
+        required_cols = ['SKU', 'MSKU']
+        if not all(col in mapping_df.columns for col in required_cols):
+            raise ValueError(f"Mapping file must contain columns: {required_cols}")
+        
+        # Repeated MSKU strings are stored once as categories; Arrow-backed SKUs
+        # get vectorized string kernels
+        mapping_df['MSKU'] = mapping_df['MSKU'].astype('category')
+        mapping_df['SKU'] = mapping_df['SKU'].astype('string[pyarrow]')
+        
+        # Index MSKUs by normalized SKU, as sales SKUs are normalized before lookup;
+        # the last row wins for duplicate keys
+        keys = mapping_df['SKU'].str.strip().str.upper()
+        keys = keys.dropna().drop_duplicates(keep='last')
+        sku_to_msku_series = pd.Series(
+            mapping_df.loc[keys.index, 'MSKU'].to_numpy(dtype=object),
+            index=pd.Index(keys.to_numpy(dtype=object))
+        )
+        
+        return mapping_df, sku_to_msku_series, self._build_choice_index(sku_to_msku_series)
+    
+    def _on_mapping_loaded(self, file_path, result):
+        self.mapping_df, self.sku_to_msku_series, choice_index = result
+        self._choice_keys, self._choice_keys_processed, self._ngram_index, self._short_choices = choice_index
+        self._fuzzy_cache = {}
+        self._mapping_loading = False
+        
+        # Update display
+        self.update_mapping_display()
+        self.stats_label.configure(text="📈 Statistics: Mapping file loaded")
+        
+        messagebox.showinfo("Success", f"Loaded {len(self.mapping_df)} SKU mappings")
+        logger.info(f"Loaded mapping file: {file_path}")
+    
+    def _on_mapping_failed(self, error):
+        self._mapping_loading = False
+        messagebox.showerror("Error", f"Failed to load mapping file: {str(error)}")
+        logger.error(f"Error loading mapping file: {error}")
     
     def load_sales_file(self):
+        if self._sales_loading or self._processing:
+            messagebox.showwarning("Warning", "Please wait for the current operation to finish")
+            return
+        
         file_path = filedialog.askopenfilename(
             title="Select Sales Data File",
             filetypes=[("CSV files", "*.csv"), ("Excel files", "*.xlsx"), 
@@ -145,104 +198,146 @@ class SKUMappingTool:
         
         if file_path:
             try:
-                if file_path.endswith('.json'):
-                    with open(file_path, 'r') as f:
-                        data = json.load(f)
-                    self.sales_df = pd.DataFrame(data)
-                elif file_path.endswith('.csv'):
-                    self.sales_df = pd.read_csv(file_path)
-                else:
-                    self.sales_df = pd.read_excel(file_path)
-                
-                # Update display
-                self.update_sales_display()
-                
-                messagebox.showinfo("Success", f"Loaded {len(self.sales_df)} sales records")
-                logger.info(f"Loaded sales file: {file_path}")
-                
+                # Show the first rows right away while the full file loads
+                if file_path.endswith('.csv'):
+                    self._populate_tree(self.sales_tab, pd.read_csv(file_path, nrows=100), limit=100)
+                elif not file_path.endswith('.json'):
+                    self._populate_tree(self.sales_tab, pd.read_excel(file_path, nrows=100), limit=100)
             except Exception as e:
-                messagebox.showerror("Error", f"Failed to load sales file: {str(e)}")
-                logger.error(f"Error loading sales file: {e}")
+                self._on_sales_failed(e)
+                return
+            
+            # The current sales_df stays until the new file has loaded;
+            # the loading flag keeps Process from running in the meantime
+            self._sales_loading = True
+            self.stats_label.configure(text="📈 Statistics: Loading sales file...")
+            self._run_in_background(
+                partial(self._read_sales, file_path),
+                partial(self._on_sales_loaded, file_path),
+                self._on_sales_failed
+            )
     
-    def update_mapping_display(self):
-        # Clear existing widgets
-        for widget in self.mapping_tab.winfo_children():
-            widget.destroy()
+    def _read_sales(self, file_path):
+        df = read_table(file_path)
+        
+        # Arrow-backed SKUs get vectorized string kernels during mapping
+        sku_column = self._find_sku_column(df)
+        if sku_column is not None:
+            df[sku_column] = df[sku_column].astype('string[pyarrow]')
+        return df
+    
+    def _on_sales_loaded(self, file_path, df):
+        self.sales_df = df
+        self._sales_loading = False
         
-        if self.mapping_df is not None:
-            # Create treeview
-            tree = ttk.Treeview(self.mapping_tab, columns=list(self.mapping_df.columns), show="headings")
-            
-            # Set column headings
-            for col in self.mapping_df.columns:
-                tree.heading(col, text=col)
-                tree.column(col, width=150)
-            
-            # Add data
-            for idx, row in self.mapping_df.iterrows():
-                tree.insert("", "end", values=list(row))
-            
-            # Scrollbar
-            scrollbar = ttk.Scrollbar(self.mapping_tab, orient="vertical", command=tree.yview)
-            tree.configure(yscrollcommand=scrollbar.set)
-            
-            tree.pack(side="left", fill="both", expand=True)
-            scrollbar.pack(side="right", fill="y")
+        # Update display
+        self.update_sales_display()
+        self.stats_label.configure(text="📈 Statistics: Sales data loaded")
+        
+        messagebox.showinfo("Success", f"Loaded {len(self.sales_df)} sales records")
+        logger.info(f"Loaded sales file: {file_path}")
     
-    def update_sales_display(self):
-        # Clear existing widgets
-        for widget in self.sales_tab.winfo_children():
-            widget.destroy()
+    def _on_sales_failed(self, error):
+        self._sales_loading = False
         
+        # Replace the preview with the sales data that is still loaded
         if self.sales_df is not None:
-            # Create treeview
-            tree = ttk.Treeview(self.sales_tab, columns=list(self.sales_df.columns), show="headings")
-            
-            # Set column headings
-            for col in self.sales_df.columns:
-                tree.heading(col, text=col)
-                tree.column(col, width=150)
-            
-            # Add data (limit to first 100 rows for performance)
-            for idx, row in self.sales_df.head(100).iterrows():
-                tree.insert("", "end", values=list(row))
-            
-            # Scrollbar
-            scrollbar = ttk.Scrollbar(self.sales_tab, orient="vertical", command=tree.yview)
-            tree.configure(yscrollcommand=scrollbar.set)
-            
-            tree.pack(side="left", fill="both", expand=True)
-            scrollbar.pack(side="right", fill="y")
+            self.update_sales_display()
+            self.stats_label.configure(text="📈 Statistics: Sales data loaded")
+        
+        messagebox.showerror("Error", f"Failed to load sales file: {str(error)}")
+        logger.error(f"Error loading sales file: {error}")
+    
+    def _run_in_background(self, work, on_success, on_error):
+        def run():
+            try:
+                result = work()
+            except Exception as e:
+                self.root.after(0, on_error, e)
+                return
+            # Tk widgets may only be touched from the main thread
+            self.root.after(0, on_success, result)
+        
+        executor.submit(run)
+    
+    def update_mapping_display(self):
+        # The tab is a preview, not a data browser
+        self._populate_tree(self.mapping_tab, self.mapping_df, limit=500)
+    
+    def update_sales_display(self):
+        # Limit to first 100 rows for performance
+        self._populate_tree(self.sales_tab, self.sales_df, limit=100)
     
     def process_mapping(self):
-        if self.sales_df is None or self.sku_to_msku == {}:
+        if self._mapping_loading or self._sales_loading or self._processing:
+            messagebox.showwarning("Warning", "Please wait for the current operation to finish")
+            return
+        
+        if self.sales_df is None or self.sku_to_msku_series.empty:
             messagebox.showwarning("Warning", "Please load both mapping and sales files first")
             return
         
+        # Find SKU column in sales data
+        sku_column = self._find_sku_column(self.sales_df)
+        if sku_column is None:
+            messagebox.showerror("Error", "No SKU column found in sales data")
+            return
+        
+        self._processing = True
+        self.stats_label.configure(text="📈 Statistics: Processing mapping...")
+        self._run_in_background(
+            partial(self._map_skus, self.sales_df[sku_column]),
+            partial(self._on_mapping_processed, sku_column),
+            self._on_processing_failed
+        )
+    
+    def _find_sku_column(self, df):
+        for col in df.columns:
+            if 'sku' in str(col).lower():
+                return col
+        return None
+    
+    def _map_skus(self, skus):
+        # Normalize and look up each distinct raw SKU once; missing SKUs get code -1
+        codes, raw_skus = pd.factorize(skus)
+        normalized = pd.Series(raw_skus).astype('string[pyarrow]').str.strip().str.upper()
+        
+        # Exact keys resolve in one hash join against the mapping index
+        msku = pd.Series(self.sku_to_msku_series.reindex(normalized).to_numpy(), index=normalized.index)
+        
+        # Only SKUs without an exact key go through fuzzy matching
+        missing_mask = msku.isna()
+        unresolved_unique = normalized[missing_mask].unique()
+        fuzzy_map = {sku: self._fuzzy_lookup(sku) for sku in unresolved_unique}
+        msku[missing_mask] = normalized[missing_mask].map(fuzzy_map)
+        
+        # Gather by the codes; the trailing None serves code -1
+        msku_values = np.append(msku.to_numpy(dtype=object), None)
+        result = pd.Series(msku_values[codes], index=skus.index)
+        
+        # Repeated MSKU strings become small integer codes over one category table;
+        # unmapped rows stay missing, with code -1
+        return result.astype('category')
+    
+    def _on_mapping_processed(self, sku_column, msku):
+        self._processing = False
+        
         try:
-            # Find SKU column in sales data
-            sku_column = None
-            for col in self.sales_df.columns:
-                if 'sku' in col.lower():
-                    sku_column = col
-                    break
-            
-            if sku_column is None:
-                messagebox.showerror("Error", "No SKU column found in sales data")
-                return
-            
             # Apply mapping
-            self.sales_df['MSKU'] = self.sales_df[sku_column].apply(self.map_sku)
+            self.sales_df['MSKU'] = msku
+            
+            # Missing MSKUs mark unmapped rows, so one null bitmap drives the stats
+            mapped_mask = msku.notna().to_numpy()
             
             # Find unmapped SKUs
-            self.unmapped_skus = self.sales_df[self.sales_df['MSKU'] == 'Unmapped'][sku_column].unique()
+            self.unmapped_skus = pd.unique(self.sales_df.loc[~mapped_mask, sku_column].to_numpy())
             
             # Update results display
             self.update_results_display()
             
             # Update statistics
             total_records = len(self.sales_df)
-            mapped_records = len(self.sales_df[self.sales_df['MSKU'] != 'Unmapped'])
+            mapped_records = int(mapped_mask.sum())
             unmapped_count = len(self.unmapped_skus)
             
             stats_text = f"📈 Statistics: {mapped_records}/{total_records} records mapped ({mapped_records/total_records*100:.1f}%)"
@@ -255,52 +350,111 @@ class SKUMappingTool:
             logger.info(f"Mapping completed: {mapped_records}/{total_records} records mapped")
             
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to process mapping: {str(e)}")
-            logger.error(f"Error processing mapping: {e}")
+            self._on_processing_failed(e)
     
-    def map_sku(self, sku):
-        if pd.isna(sku):
-            return "Unmapped"
-        
-        # Normalize SKU
-        sku_str = str(sku).strip().upper()
-        
-        # Direct mapping
-        if sku_str in self.sku_to_msku:
-            return self.sku_to_msku[sku_str]
-        
-        # Fuzzy matching for similar SKUs
-        if len(self.sku_to_msku) > 0:
-            best_match = process.extractOne(sku_str, self.sku_to_msku.keys())
-            if best_match and best_match[1] >= 80:  # 80% similarity threshold
-                return self.sku_to_msku[best_match[0]]
-        
-        return "Unmapped"
+    def _on_processing_failed(self, error):
+        self._processing = False
+        messagebox.showerror("Error", f"Failed to process mapping: {str(error)}")
+        logger.error(f"Error processing mapping: {error}")
+    
+    def _build_choice_index(self, sku_to_msku_series):
+        # Preprocess the fuzzy-match choices once per mapping file
+        choice_keys = sku_to_msku_series.index.tolist()
+        choice_keys_processed = [utils.default_process(key) for key in choice_keys]
+        
+        # Inverted index from each character n-gram and whole token to the choices containing it;
+        # choices shorter than an n-gram can partially match anything, so they are always scored
+        ngram_index = {}
+        short_choices = set()
+        for idx, key in enumerate(choice_keys_processed):
+            if len(key.replace(' ', '')) < NGRAM_SIZE:
+                short_choices.add(idx)
+                continue
+            for term in self._index_terms(key):
+                ngram_index.setdefault(term, set()).add(idx)
+        
+        return choice_keys, choice_keys_processed, ngram_index, short_choices
+    
+    def _index_terms(self, text):
+        # Grams skip whitespace so "a 12" and "a12" still share one; tokens are indexed too,
+        # since one shared short token is enough for a high token-set score
+        compact = text.replace(' ', '')
+        grams = {compact[i:i + NGRAM_SIZE] for i in range(len(compact) - NGRAM_SIZE + 1)}
+        return grams.union(text.split())
+    
+    def _fuzzy_lookup(self, sku):
+        # Each distinct SKU is scored at most once per mapping file
+        if sku not in self._fuzzy_cache:
+            self._fuzzy_cache[sku] = self._best_fuzzy_match(sku)
+        return self._fuzzy_cache[sku]
+    
+    def _best_fuzzy_match(self, sku):
+        query = utils.default_process(sku)
+        
+        # Only score choices sharing at least one n-gram or token with the query,
+        # falling back to every choice when nothing shares one
+        candidates = set()
+        if len(query.replace(' ', '')) >= NGRAM_SIZE:
+            candidates = set(self._short_choices)
+            for term in self._index_terms(query):
+                candidates |= self._ngram_index.get(term, set())
+        if not candidates:
+            candidates = range(len(self._choice_keys))
+        
+        # Sorted so ties resolve to the earliest choice, as a full scan would
+        best_match = process.extractOne(
+            query,
+            {idx: self._choice_keys_processed[idx] for idx in sorted(candidates)},
+            scorer=fuzz.WRatio,
+            processor=None,
+            score_cutoff=FUZZY_MATCH_THRESHOLD
+        )
+        if best_match is None:
+            return None
+        return self.sku_to_msku_series.iloc[best_match[2]]
     
     def update_results_display(self):
+        # Limit to first 100 rows for performance
+        self._populate_tree(self.results_tab, self._label_unmapped(self.sales_df.head(100)), limit=100)
+    
+    def _label_unmapped(self, df):
+        if 'MSKU' not in df.columns or not isinstance(df['MSKU'].dtype, pd.CategoricalDtype):
+            return df
+        
+        # Shallow copy, so the labelled column never reaches self.sales_df
+        msku = df['MSKU']
+        if UNMAPPED_LABEL not in msku.cat.categories:
+            msku = msku.cat.add_categories(UNMAPPED_LABEL)
+        labelled = df.copy(deep=False)
+        labelled['MSKU'] = msku.fillna(UNMAPPED_LABEL)
+        return labelled
+    
+    def _populate_tree(self, tab, df, limit=100):
         # Clear existing widgets
-        for widget in self.results_tab.winfo_children():
+        for widget in tab.winfo_children():
             widget.destroy()
         
-        if self.sales_df is not None:
-            # Create treeview
-            tree = ttk.Treeview(self.results_tab, columns=list(self.sales_df.columns), show="headings")
-            
-            # Set column headings
-            for col in self.sales_df.columns:
-                tree.heading(col, text=col)
-                tree.column(col, width=150)
-            
-            # Add data (limit to first 100 rows for performance)
-            for idx, row in self.sales_df.head(100).iterrows():
-                tree.insert("", "end", values=list(row))
-            
-            # Scrollbar
-            scrollbar = ttk.Scrollbar(self.results_tab, orient="vertical", command=tree.yview)
-            tree.configure(yscrollcommand=scrollbar.set)
-            
-            tree.pack(side="left", fill="both", expand=True)
-            scrollbar.pack(side="right", fill="y")
+        if df is None:
+            return
+        
+        # Create treeview
+        tree = ttk.Treeview(tab, columns=list(df.columns), show="headings")
+        
+        # Set column headings
+        for col in df.columns:
+            tree.heading(col, text=col)
+            tree.column(col, width=150)
+        
+        # Insert plain value lists while the tree is still unpacked, so Tk lays it out once
+        for values in df.head(limit).to_numpy(dtype=object).tolist():
+            tree.insert("", "end", values=values)
+        
+        # Scrollbar
+        scrollbar = ttk.Scrollbar(tab, orient="vertical", command=tree.yview)
+        tree.configure(yscrollcommand=scrollbar.set)
+        
+        tree.pack(side="left", fill="both", expand=True)
+        scrollbar.pack(side="right", fill="y")
     
     def export_results(self):
         if self.sales_df is None:
@@ -310,15 +464,19 @@ class SKUMappingTool:
         file_path = filedialog.asksaveasfilename(
             title="Export Results",
             defaultextension=".csv",
-            filetypes=[("CSV files", "*.csv"), ("Excel files", "*.xlsx")]
+            filetypes=[("CSV files", "*.csv"), ("Excel files", "*.xlsx"), ("Parquet files", "*.parquet")]
         )
         
         if file_path:
             try:
+                results = self._label_unmapped(self.sales_df)
                 if file_path.endswith('.csv'):
-                    self.sales_df.to_csv(file_path, index=False)
+                    results.to_csv(file_path, index=False)
+                elif file_path.endswith('.parquet'):
+                    # Columnar and compressed; much faster to write and read back than CSV
+                    results.to_parquet(file_path, engine='pyarrow', compression='zstd', index=False)
                 else:
-                    self.sales_df.to_excel(file_path, index=False)
+                    write_excel(results, file_path)
                 
                 messagebox.showinfo("Success", f"Results exported to {file_path}")
                 logger.info(f"Results exported to: {file_path}")
@@ -0,0 +1,129 @@
+import os
+import re
+import json
+import sqlite3
+import uuid
+import logging
+from contextlib import closing
+from datetime import datetime
+import duckdb
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+DATA_FOLDER = 'uploads'
+METADATA_DB = os.path.join(DATA_FOLDER, 'metadata.db')
+
+# Frames already loaded by this worker, keyed by dataset name
+_frames = {}
+
+# Object columns inferred as these hold several value types, which one Arrow column cannot
+MIXED_TYPES = {'mixed', 'mixed-integer'}
+
+def _connect():
+    """Open the metadata database, creating the table on first use"""
+    os.makedirs(DATA_FOLDER, exist_ok=True)
+    conn = sqlite3.connect(METADATA_DB)
+    conn.row_factory = sqlite3.Row
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS datasets (
+            name TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            columns TEXT NOT NULL,
+            rows INTEGER NOT NULL,
+            info TEXT,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    return conn
+
+def _arrow_compatible(df):
+    """Cast mixed-type object columns, such as numbers and text in one JSON field, to strings"""
+    mixed = [
+        col for col in df.columns
+        if df[col].dtype == object and pd.api.types.infer_dtype(df[col], skipna=True) in MIXED_TYPES
+    ]
+    if not mixed:
+        return df
+    return df.astype({col: 'string' for col in mixed})
+
+def save_dataset(name, df, info=None):
+    """Write a DataFrame to Parquet and register it as the current dataset for name"""
+    df = _arrow_compatible(df)
+    path = os.path.join(DATA_FOLDER, f'{name}_{uuid.uuid4().hex}.parquet')
+    df.to_parquet(path, engine='pyarrow', compression='zstd', index=False)
+    
+    with closing(_connect()) as conn, conn:
+        previous = conn.execute('SELECT path FROM datasets WHERE name = ?', (name,)).fetchone()
+        conn.execute(
+            'INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?, ?, ?)',
+            (
+                name,
+                path,
+                json.dumps([str(col) for col in df.columns]),
+                len(df),
+                json.dumps(info) if info is not None else None,
+                datetime.now().isoformat()
+            )
+        )
+    
+    _frames[name] = (path, df)
+    
+    # Another worker may have resolved the previous path via get_dataset but not
+    # opened it yet, so keep one generation back and only remove older files
+    keep = {path, previous['path']} if previous else {path}
+    pattern = re.compile(rf'{re.escape(name)}_[0-9a-f]{{32}}\.parquet')
+    for filename in os.listdir(DATA_FOLDER):
+        old_path = os.path.join(DATA_FOLDER, filename)
+        if pattern.fullmatch(filename) and old_path not in keep:
+            try:
+                os.remove(old_path)
+            except OSError as e:
+                logger.warning(f"Could not remove old dataset file {old_path}: {e}")
+    
+    return path
+
+def get_dataset(name):
+    """Get metadata for the current dataset, or None if nothing is stored"""
+    with closing(_connect()) as conn:
+        row = conn.execute('SELECT * FROM datasets WHERE name = ?', (name,)).fetchone()
+    
+    if row is None:
+        return None
+    
+    return {
+        'path': row['path'],
+        'columns': json.loads(row['columns']),
+        'rows': row['rows'],
+        'info': json.loads(row['info']) if row['info'] else None,
+        'updated_at': row['updated_at']
+    }
+
+def _arrow_dtype(arrow_type):
+    """Map Arrow types to ArrowDtype, leaving dictionaries to become categoricals"""
+    if pa.types.is_dictionary(arrow_type):
+        return None
+    return pd.ArrowDtype(arrow_type)
+
+def load_dataset(name):
+    """Load the current dataset, reusing this worker's copy while it is still current"""
+    dataset = get_dataset(name)
+    if dataset is None:
+        return None
+    
+    cached = _frames.get(name)
+    if cached and cached[0] == dataset['path']:
+        return cached[1]
+    
+    # Memory-map the file and keep columns Arrow-backed; categoricals stay categorical
+    table = pq.read_table(dataset['path'], memory_map=True)
+    df = table.to_pandas(types_mapper=_arrow_dtype)
+    _frames[name] = (dataset['path'], df)
+    return df
+
+def query(sql, params=None):
+    """Run a DuckDB query and return the result as a DataFrame"""
+    with duckdb.connect() as conn:
+        return conn.execute(sql, params or []).df()
@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage
+
+
+@pytest.fixture
+def data_folder(tmp_path, monkeypatch):
+    # Each test gets its own Parquet files and metadata database
+    monkeypatch.setattr(storage, 'DATA_FOLDER', str(tmp_path))
+    monkeypatch.setattr(storage, 'METADATA_DB', str(tmp_path / 'metadata.db'))
+    monkeypatch.setattr(storage, '_frames', {})
+    return tmp_path
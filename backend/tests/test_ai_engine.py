@@ -0,0 +1,143 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import openai
+import pytest
+
+from ai import text_to_sql
+from ai.text_to_sql import AIQueryEngine, RateLimiter
+
+
+def completion(content):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+def context_length_error():
+    return openai.error.InvalidRequestError('too many tokens', None, code='context_length_exceeded')
+
+
+@pytest.fixture
+def engine():
+    return AIQueryEngine(requests_per_minute=10000, tokens_per_minute=10000000)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    # Record backoff delays instead of waiting them out
+    delays = []
+    
+    async def fake_sleep(delay):
+        delays.append(delay)
+    
+    monkeypatch.setattr(text_to_sql.asyncio, 'sleep', fake_sleep)
+    return delays
+
+
+def stub_acreate(engine, outcomes):
+    """Replace _acreate with one that raises or returns each outcome in turn"""
+    calls = []
+    
+    async def fake_acreate(messages, max_tokens=1000):
+        calls.append(messages)
+        outcome = outcomes[len(calls) - 1]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return completion(outcome)
+    
+    engine._acreate = fake_acreate
+    return calls
+
+
+def test_aquery_trims_history_without_using_a_retry(engine, sleeps):
+    engine.max_retries = 1
+    engine.conversation_history.extend([{'role': 'user', 'content': 'earlier'}] * 4)
+    calls = stub_acreate(engine, [openai.error.RateLimitError('slow down'), context_length_error(), 'answer'])
+    
+    result = asyncio.run(engine.aquery('total orders?', use_cache=False))
+    
+    assert result['response'] == 'answer'
+    assert [len(messages) for messages in calls] == [6, 6, 4]
+    assert len(sleeps) == 1
+
+
+def test_aquery_backs_off_on_rate_limits_then_raises(engine, sleeps):
+    engine.max_retries = 2
+    calls = stub_acreate(engine, [openai.error.RateLimitError('slow down')] * 3)
+    
+    result = asyncio.run(engine.aquery('total orders?', use_cache=False))
+    
+    assert len(calls) == 3
+    assert result['query_type'] == 'error'
+    assert 'slow down' in result['response']
+    # Exponential backoff with up to a second of jitter
+    assert 1 <= sleeps[0] < 2
+    assert 2 <= sleeps[1] < 3
+
+
+def test_aquery_reports_context_error_once_history_is_trimmed(engine, sleeps):
+    calls = stub_acreate(engine, [context_length_error(), context_length_error()])
+    
+    result = asyncio.run(engine.aquery('total orders?', use_cache=False))
+    
+    assert len(calls) == 2
+    assert result['query_type'] == 'error'
+    assert 'too many tokens' in result['response']
+
+
+def test_rate_limiter_spaces_out_calls():
+    # 6000 tokens a minute refill at 100 a second
+    limiter = RateLimiter(requests_per_minute=10000, tokens_per_minute=6000)
+    
+    async def acquire_all():
+        await limiter.acquire(6000)
+        stamps = []
+        for _ in range(3):
+            await limiter.acquire(20)
+            stamps.append(time.monotonic())
+        return stamps
+    
+    start = time.monotonic()
+    stamps = asyncio.run(acquire_all())
+    
+    # Once the bucket is drained, each 20-token call waits about 0.2s for its refill
+    gaps = [later - earlier for earlier, later in zip([start] + stamps, stamps)]
+    assert all(gap >= 0.15 for gap in gaps)
+
+
+def stub_batch(engine, batch_content):
+    """Answer the batched request with batch_content and single queries with their own text"""
+    calls = []
+    
+    async def fake_acreate(messages, max_tokens=1000):
+        prompt = messages[1]['content']
+        calls.append(prompt)
+        if 'User Queries:' in prompt:
+            return completion(batch_content)
+        return completion('single: ' + prompt.split('User Query: ', 1)[1])
+    
+    engine._acreate = fake_acreate
+    return calls
+
+
+def test_query_batch_uses_one_request_for_well_formed_answers(engine):
+    calls = stub_batch(engine, 'Here you go: ["first", "second"]')
+    
+    results = asyncio.run(engine.query_batch(['top products?', 'mapping rate?']))
+    
+    assert len(calls) == 1
+    assert [r['response'] for r in results] == ['first', 'second']
+
+
+@pytest.mark.parametrize('batch_content', [
+    '["only one answer"]',
+    'I cannot answer these as JSON.',
+    '["unterminated", ',
+], ids=['wrong-length', 'no-array', 'bad-json'])
+def test_query_batch_falls_back_to_one_request_per_query(engine, batch_content):
+    calls = stub_batch(engine, batch_content)
+    
+    results = asyncio.run(engine.query_batch(['top products?', 'mapping rate?']))
+    
+    assert len(calls) == 3
+    assert [r['response'] for r in results] == ['single: top products?', 'single: mapping rate?']
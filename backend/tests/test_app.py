@@ -0,0 +1,82 @@
+import pandas as pd
+import pytest
+
+import app
+import storage
+
+
+@pytest.fixture
+def client(data_folder, monkeypatch):
+    for cache in ('mapping_index_cache', 'analytics_cache', 'ai_sales_cache'):
+        monkeypatch.setattr(app, cache, {})
+    return app.app.test_client()
+
+
+def test_process_keeps_date_text_and_parses_it_for_ai(client):
+    dates = ['2024-01-05', '25/01/2024', '2024-01-03 10:30:00', 'not a date']
+    storage.save_dataset('mapping', pd.DataFrame({'SKU': ['A1'], 'MSKU': ['M1']}))
+    storage.save_dataset('sales', pd.DataFrame({'SKU': ['A1'] * 4, 'Date': dates}))
+    
+    assert client.post('/api/process').status_code == 200
+    
+    # The stored and exported column is the user's text
+    assert storage.load_dataset('processed')['Date'].tolist() == dates
+    export = client.post('/api/export', json={'format': 'csv'}).get_data(as_text=True)
+    assert export.splitlines()[1:] == [f'A1,{date},M1' for date in dates]
+    
+    parsed = app.get_data_context()['sales_data']['Date']
+    assert parsed.dtype.kind == 'M'
+    assert parsed.tolist()[:3] == [
+        pd.Timestamp('2024-01-05'),
+        pd.Timestamp('2024-01-25'),
+        pd.Timestamp('2024-01-03 10:30:00')
+    ]
+    assert pd.isna(parsed.iloc[3])
+
+
+def test_csv_export_matches_to_csv(client, monkeypatch):
+    monkeypatch.setattr(app, 'EXPORT_CHUNK_ROWS', 2)
+    df = pd.DataFrame({
+        'SKU': ['A1', 'B2', 'C3', 'D4', 'E5'],
+        'Quantity': [1.0, 2.5, None, 4.0, 5.0],
+        'MSKU': pd.Categorical(['M1', 'Unmapped', 'M1', 'M2', 'Unmapped'])
+    })
+    storage.save_dataset('processed', df)
+    
+    # Streamed in chunks of two rows, with the header only once
+    export = client.post('/api/export', json={'format': 'csv'}).get_data(as_text=True)
+    assert export == df.to_csv(index=False)
+
+
+@pytest.mark.parametrize('min_pairs', [app.NUMBA_MATCH_MIN_PAIRS, 0], ids=['cdist', 'prefix-numba'])
+def test_map_skus_paths_agree(monkeypatch, min_pairs):
+    monkeypatch.setattr(app, 'NUMBA_MATCH_MIN_PAIRS', min_pairs)
+    mapping_index = app.build_mapping_index(pd.DataFrame({
+        'SKU': ['WIDGET-BLUE-001', 'gadget-red-002 ', 'GIZMO-GREEN-003'],
+        'MSKU': ['M1', 'M2', 'M3']
+    }))
+    skus = pd.Series([
+        'WIDGET-BLUE-001',   # exact
+        ' gadget-red-002',   # exact after strip and upper
+        'WIDGET-BLUE-0001',  # fuzzy, same prefix as its key
+        'XGIZMO-GREEN-003',  # fuzzy, no key shares its prefix
+        'ZZZ-999',
+        None
+    ])
+    
+    msku = app.map_skus(skus, mapping_index)
+    
+    assert msku.tolist() == ['M1', 'M2', 'M1', 'M3', 'Unmapped', 'Unmapped']
+
+
+@pytest.mark.parametrize('queries', [
+    None,
+    [],
+    ['top products?', 42],
+    ['top products?', {'query': 'mapping rate?'}],
+    ['   '],
+    ['query'] * (app.MAX_AI_BATCH_QUERIES + 1)
+])
+def test_ai_batch_rejects_invalid_queries(client, queries):
+    response = client.post('/api/ai/batch', json={'queries': queries})
+    assert response.status_code == 400
@@ -0,0 +1,44 @@
+import pandas as pd
+
+import file_io
+
+
+def test_write_excel_round_trips_rows_across_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(file_io, 'EXPORT_CHUNK_ROWS', 2)
+    df = pd.DataFrame({
+        'SKU': ['A1', 'B2', None, 'D4', 'E5'],
+        'MSKU': pd.Categorical(['M1', 'M2', 'M1', None, 'M2']),
+        'Quantity': [1, 2, 3, 4, 5],
+        'Date': pd.to_datetime(['2024-01-01', '2024-01-02', None, '2024-01-04', '2024-01-05'])
+    })
+    path = tmp_path / 'results.xlsx'
+    
+    file_io.write_excel(df, path, sheet_name='Processed Data')
+    
+    loaded = pd.read_excel(path, sheet_name='Processed Data')
+    pd.testing.assert_frame_equal(loaded, df.astype({'MSKU': object}), check_dtype=False)
+
+
+def test_read_table_csv_matches_default_parser(tmp_path):
+    path = tmp_path / 'sales.csv'
+    path.write_text('SKU,SKU,Quantity,Date\nA1,X,1,2024-01-05\nB2,Y,,2024-01-06\n')
+    
+    df = file_io.read_table(str(path))
+    
+    # Same de-duplicated names as pandas' own parser, and dates stay text
+    assert list(df.columns) == ['SKU', 'SKU.1', 'Quantity', 'Date']
+    assert df['Date'].tolist() == ['2024-01-05', '2024-01-06']
+    assert df['Quantity'].tolist()[0] == 1
+    assert pd.isna(df['Quantity'].iloc[1])
+
+
+def test_read_table_reads_excel_and_json(tmp_path):
+    df = pd.DataFrame({'SKU': ['A1', 'B2'], 'MSKU': ['M1', 'M2']})
+    excel_path = tmp_path / 'mapping.xlsx'
+    file_io.write_excel(df, excel_path)
+    json_path = tmp_path / 'mapping.json'
+    json_path.write_text(df.to_json(orient='records'))
+    
+    for path in (excel_path, json_path):
+        loaded = file_io.read_table(str(path))
+        assert loaded.to_dict('list') == df.to_dict('list')
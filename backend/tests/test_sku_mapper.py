@@ -0,0 +1,44 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip('customtkinter')
+
+import sku_mapper
+from sku_mapper import SKUMappingTool
+
+
+def make_tool(mapping):
+    # Skip the Tk window; only the mapping index is needed
+    tool = SKUMappingTool.__new__(SKUMappingTool)
+    tool.sku_to_msku_series = pd.Series(list(mapping.values()), index=list(mapping.keys()))
+    choice_index = tool._build_choice_index(tool.sku_to_msku_series)
+    tool._choice_keys, tool._choice_keys_processed, tool._ngram_index, tool._short_choices = choice_index
+    tool._fuzzy_cache = {}
+    return tool
+
+
+def test_fuzzy_match_short_hyphenated_sku():
+    # "A-12" processes to "a 12", which shares no 3-gram or token with "a12"
+    tool = make_tool({'A12': 'MSKU-1', 'ZZZZ-9999': 'MSKU-2'})
+    assert tool._fuzzy_lookup('A-12') == 'MSKU-1'
+
+
+def test_csv_export_matches_to_csv(tmp_path, monkeypatch):
+    path = tmp_path / 'results.csv'
+    monkeypatch.setattr(sku_mapper.filedialog, 'asksaveasfilename', lambda **kwargs: str(path))
+    monkeypatch.setattr(sku_mapper.messagebox, 'showinfo', lambda *args: None)
+    monkeypatch.setattr(sku_mapper.messagebox, 'showerror', lambda *args: pytest.fail(args[1]))
+    
+    tool = make_tool({'A12': 'MSKU-1'})
+    tool.sales_df = pd.DataFrame({
+        'SKU': ['A12', 'B34', 'A12'],
+        'Quantity': [1.0, 2.5, None],
+        'Gift': [True, False, True],
+        'Date': ['2024-01-01', '05/01/2024', '2024-01-03 10:30:00'],
+        'MSKU': pd.Categorical(['MSKU-1', None, 'MSKU-1'])
+    })
+    
+    tool.export_results()
+    
+    expected = tool.sales_df.assign(MSKU=['MSKU-1', 'Unmapped', 'MSKU-1']).to_csv(index=False)
+    assert path.read_text() == expected
@@ -0,0 +1,58 @@
+import os
+import re
+
+import pandas as pd
+
+import storage
+
+
+def parquet_files(folder, name):
+    pattern = re.compile(rf'{name}_[0-9a-f]{{32}}\.parquet')
+    return sorted(f for f in os.listdir(folder) if pattern.fullmatch(f))
+
+
+def test_mixed_type_column_round_trips(data_folder):
+    df = pd.DataFrame({'SKU': ['A1', 'B2', 'C3'], 'Quantity': [1, 'two', None]})
+    storage.save_dataset('sales', df)
+    
+    storage._frames.clear()
+    loaded = storage.load_dataset('sales')
+    assert loaded['SKU'].tolist() == ['A1', 'B2', 'C3']
+    assert loaded['Quantity'].tolist()[:2] == ['1', 'two']
+    assert pd.isna(loaded['Quantity'].iloc[2])
+
+
+def test_load_dataset_reads_the_current_file(data_folder):
+    storage.save_dataset('sales', pd.DataFrame({'SKU': ['A1']}), info={'source': 'first'})
+    storage.save_dataset('sales', pd.DataFrame({'SKU': ['B2', 'C3']}), info={'source': 'second'})
+    
+    dataset = storage.get_dataset('sales')
+    assert dataset['rows'] == 2
+    assert dataset['columns'] == ['SKU']
+    assert dataset['info'] == {'source': 'second'}
+    
+    # Another worker has nothing cached and reads the Parquet file
+    storage._frames.clear()
+    assert storage.load_dataset('sales')['SKU'].tolist() == ['B2', 'C3']
+    assert storage.load_dataset('missing') is None
+
+
+def test_save_keeps_one_previous_generation(data_folder):
+    paths = [storage.save_dataset('sales', pd.DataFrame({'SKU': [str(i)]})) for i in range(4)]
+    storage.save_dataset('sales_archive', pd.DataFrame({'SKU': ['X']}))
+    
+    # Only the current and previous sales files remain; other datasets are untouched
+    assert parquet_files(data_folder, 'sales') == sorted(os.path.basename(p) for p in paths[-2:])
+    assert len(parquet_files(data_folder, 'sales_archive')) == 1
+
+
+def test_categorical_round_trips(data_folder):
+    df = pd.DataFrame({'MSKU': pd.Categorical(['M1', 'M2', None, 'M1'])})
+    storage.save_dataset('processed', df)
+    
+    storage._frames.clear()
+    msku = storage.load_dataset('processed')['MSKU']
+    assert isinstance(msku.dtype, pd.CategoricalDtype)
+    assert msku.tolist()[:2] == ['M1', 'M2']
+    assert pd.isna(msku.iloc[2])
+    assert msku.cat.codes.tolist() == [0, 1, -1, 0]